@@ -1,7 +1,18 @@
-import json
+import os
+import asyncio
 import yaml
-from itertools import islice
+import orjson
+import hashlib
+from collections import Counter
+from itertools import chain
 from bbot.modules.base import BaseModule
+from bbot.core.errors import ValidationError
+
+# prefer the libyaml C loader, it is several times faster on the thousands of templates processed in budget mode
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 
 class nuclei(BaseModule):
@@ -16,13 +27,14 @@ class nuclei(BaseModule):
         "templates": "",
         "severity": "",
         "ratelimit": 150,
-        "concurrency": 25,
+        "concurrency": 0,
         "mode": "manual",
         "etags": "",
         "budget": 1,
         "directory_only": True,
         "retries": 0,
         "batch_size": 200,
+        "update_templates_ttl": 24,
     }
     options_desc = {
         "version": "nuclei version",
@@ -30,13 +42,14 @@ class nuclei(BaseModule):
         "templates": "template or template directory paths to include in the scan",
         "severity": "Filter based on severity field available in the template.",
         "ratelimit": "maximum number of requests to send per second (default 150)",
-        "concurrency": "maximum number of templates to be executed in parallel (default 25)",
+        "concurrency": "maximum number of templates to be executed in parallel, 0 picks min(25, 2x CPU cores). Lower values often improve throughput on modest targets (default 0)",
         "mode": "manual | technology | severe | budget. Technology: Only activate based on technology events that match nuclei tags (nuclei -as mode). Manual (DEFAULT): Fully manual settings. Severe: Only critical and high severity templates without intrusive. Budget: Limit Nuclei to a specified number of HTTP requests",
         "etags": "tags to exclude from the scan",
         "budget": "Used in budget mode to set the number of requests which will be allotted to the nuclei scan",
         "directory_only": "Filter out 'file' URL event (default True)",
         "retries": "number of times to retry a failed request (default 0)",
         "batch_size": "Number of targets to send to Nuclei per batch (default 200)",
+        "update_templates_ttl": "Hours to wait before updating nuclei templates again, 0 updates on every scan (default 24)",
     }
     deps_ansible = [
         {
@@ -49,30 +62,43 @@ class nuclei(BaseModule):
             },
         }
     ]
-    deps_pip = ["pyyaml~=6.0"]
+    deps_pip = ["pyyaml~=6.0", "orjson~=3.9"]
     in_scope_only = True
     _batch_size = 25
 
     async def setup(self):
-        # attempt to update nuclei templates
+        # attempt to update nuclei templates, unless they were already updated recently
         self.nuclei_templates_dir = self.helpers.tools_dir / "nuclei-templates"
-        self.info("Updating Nuclei templates")
-        update_results = await self.helpers.run(
-            ["nuclei", "-update-template-dir", self.nuclei_templates_dir, "-update-templates"]
-        )
-        if update_results.stderr:
-            if "Successfully downloaded nuclei-templates" in update_results.stderr:
-                self.success("Successfully updated nuclei templates")
-            elif "No new updates found for nuclei templates" in update_results.stderr:
-                self.info("Nuclei templates already up-to-date")
-            else:
-                self.warning(f"Failure while updating nuclei templates: {update_results.stderr}")
+        update_templates_ttl = float(self.config.get("update_templates_ttl", 24))
+        update_cache_key = self.templates_update_cache_key(self.config.get("version", ""), self.nuclei_templates_dir)
+        if self.nuclei_templates_dir.is_dir() and self.helpers.is_cached(
+            update_cache_key, cache_hrs=update_templates_ttl
+        ):
+            self.info(f"Nuclei templates were updated less than {update_templates_ttl:g} hours ago, skipping update")
         else:
-            self.warning("Error running nuclei template update command")
+            self.info("Updating Nuclei templates")
+            update_results = await self.helpers.run(
+                ["nuclei", "-update-template-dir", self.nuclei_templates_dir, "-update-templates"]
+            )
+            if update_results.stderr:
+                if "Successfully downloaded nuclei-templates" in update_results.stderr:
+                    self.success("Successfully updated nuclei templates")
+                    self.helpers.cache_put(update_cache_key, "")
+                elif "No new updates found for nuclei templates" in update_results.stderr:
+                    self.info("Nuclei templates already up-to-date")
+                    self.helpers.cache_put(update_cache_key, "")
+                else:
+                    self.warning(f"Failure while updating nuclei templates: {update_results.stderr}")
+            else:
+                self.warning("Error running nuclei template update command")
         self.proxy = self.scan.config.get("http_proxy", "")
         self.mode = self.config.get("mode", "severe")
         self.ratelimit = int(self.config.get("ratelimit", 150))
-        self.concurrency = int(self.config.get("concurrency", 25))
+        self.concurrency = int(self.config.get("concurrency", 0))
+        if self.concurrency <= 0:
+            # high concurrency often lowers throughput against modest targets, so scale the default with the machine
+            self.concurrency = min(25, (os.cpu_count() or 1) * 2)
+            self.verbose(f"Setting nuclei concurrency to {self.concurrency} based on CPU count")
         self.budget = int(self.config.get("budget", 1))
         self.templates = self.config.get("templates")
         if self.templates:
@@ -117,9 +143,13 @@ class nuclei(BaseModule):
                 f"Running nuclei in BUDGET mode. This mode calculates which nuclei templates can be used, constrained by your 'budget' of number of requests. Current budget is set to: {self.budget}"
             )
 
+            if not self.nuclei_templates_dir.is_dir():
+                return False, f"Nuclei templates directory [{self.nuclei_templates_dir}] does not exist"
+
             self.info("Processing nuclei templates to perform budget calculations...")
 
             self.nucleibudget = NucleiBudget(self)
+            await self.nucleibudget.setup()
             self.budget_templates_file = self.helpers.tempfile(self.nucleibudget.collapsable_templates, pipe=False)
 
             self.info(
@@ -129,19 +159,37 @@ class nuclei(BaseModule):
                 f"Template Severity: Critical [{self.nucleibudget.severity_stats['critical']}] High [{self.nucleibudget.severity_stats['high']}] Medium [{self.nucleibudget.severity_stats['medium']}] Low [{self.nucleibudget.severity_stats['low']}] Info [{self.nucleibudget.severity_stats['info']}] Unknown [{self.nucleibudget.severity_stats['unknown']}]"
             )
 
+        self.nuclei_command = self.build_nuclei_command()
         return True
 
     async def handle_batch(self, *events):
         temp_target = self.helpers.make_target(*events)
         nuclei_input = [str(e.data) for e in events]
+        # index events by host so most results can be correlated without a linear scan of the batch
+        host_index = {}
+        for e in events:
+            host_index.setdefault(e.host, e)
+        # a single URL often yields many results, so only stringify each source event's host once
+        host_strs = {}
         async for severity, template, host, url, name, extracted_results in self.execute_nuclei(nuclei_input):
-            # this is necessary because sometimes nuclei is inconsistent about the data returned in the host field
-            cleaned_host = temp_target.get(host)
-            source_event = self.correlate_event(events, cleaned_host)
-
-            if not source_event:
+            # an exact host match wins, even over an earlier event for a parent domain
+            try:
+                result_host = self.scan.make_event(host, dummy=True).host
+            except ValidationError:
+                result_host = None
+            source_event = host_index.get(result_host, None)
+            if source_event is None:
+                # this is necessary because sometimes nuclei is inconsistent about the data returned in the host field
+                cleaned_host = temp_target.get(host)
+                source_event = self.correlate_event(events, cleaned_host)
+
+            if source_event is None:
                 continue
 
+            host_str = host_strs.get(id(source_event), None)
+            if host_str is None:
+                host_str = host_strs[id(source_event)] = str(source_event.host)
+
             if url == "":
                 url = str(source_event.data)
 
@@ -152,7 +200,7 @@ class nuclei(BaseModule):
             if severity in ["INFO", "UNKNOWN"]:
                 self.emit_event(
                     {
-                        "host": str(source_event.host),
+                        "host": host_str,
                         "url": url,
                         "description": description_string,
                     },
@@ -163,7 +211,7 @@ class nuclei(BaseModule):
                 self.emit_event(
                     {
                         "severity": severity,
-                        "host": str(source_event.host),
+                        "host": host_str,
                         "url": url,
                         "description": description_string,
                     },
@@ -171,6 +219,10 @@ class nuclei(BaseModule):
                     source_event,
                 )
 
+    @staticmethod
+    def templates_update_cache_key(version, templates_dir):
+        return f"nuclei-templates-update:{version}:{templates_dir}"
+
     def correlate_event(self, events, host):
         for event in events:
             if host in event:
@@ -179,7 +231,8 @@ class nuclei(BaseModule):
         for event in events:
             self.verbose(f" - {event.data}")
 
-    async def execute_nuclei(self, nuclei_input):
+    # nothing in the nuclei command line depends on the batch, so it is only assembled once during setup
+    def build_nuclei_command(self):
         command = [
             "nuclei",
             "-jsonl",
@@ -205,7 +258,7 @@ class nuclei(BaseModule):
                 command.append(f"-{cli_option}")
                 command.append(option)
 
-        if self.scan.config.get("interactsh_disable") == True:
+        if self.scan.config.get("interactsh_disable", False):
             self.info("Disbling interactsh in accordance with global settings")
             command.append("-no-interactsh")
 
@@ -220,17 +273,24 @@ class nuclei(BaseModule):
             command.append("-proxy")
             command.append(f"{self.proxy}")
 
+        return tuple(command)
+
+    async def execute_nuclei(self, nuclei_input):
         stats_file = self.helpers.tempfile_tail(callback=self.log_nuclei_status)
         try:
             with open(stats_file, "w") as stats_fh:
-                async for line in self.helpers.run_live(command, input=nuclei_input, stderr=stats_fh):
+                # read raw bytes, orjson parses them directly without a separate decode step
+                async for line in self.helpers.run_live(
+                    self.nuclei_command, input=nuclei_input, stderr=stats_fh, text=False
+                ):
                     try:
-                        j = json.loads(line)
-                    except json.decoder.JSONDecodeError:
-                        self.debug(f"Failed to decode line: {line}")
+                        j = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        self.debug(f"Failed to decode line: {self.helpers.smart_decode(line)}")
                         continue
 
                     template = j.get("template-id", "")
+                    info = j.get("info", {})
 
                     # try to get the specific matcher name
                     name = j.get("matcher-name", "")
@@ -240,8 +300,8 @@ class nuclei(BaseModule):
                         self.debug(
                             f"Couldn't get matcher-name from nuclei json, falling back to regular name. Template: [{template}]"
                         )
-                        name = j.get("info", {}).get("name", "")
-                    severity = j.get("info", {}).get("severity", "").upper()
+                        name = info.get("name", "")
+                    severity = info.get("severity", "").upper()
                     host = j.get("host", "")
                     url = j.get("matched-at", "")
                     if not self.helpers.is_url(url):
@@ -258,7 +318,7 @@ class nuclei(BaseModule):
 
     def log_nuclei_status(self, line):
         try:
-            line = json.loads(line)
+            line = orjson.loads(line)
         except Exception:
             self.info(str(line))
             return
@@ -289,98 +349,144 @@ class nuclei(BaseModule):
 
 
 class NucleiBudget:
+    # bump whenever the format of the cached template metadata changes
+    cache_version = 2
+    # number of templates handed to each process pool task
+    chunk_size = 32
+
     def __init__(self, nuclei_module):
         self.parent = nuclei_module
-        self._yaml_files = {}
         self.templates_dir = nuclei_module.nuclei_templates_dir
-        self.yaml_list = self.get_yaml_list()
-        self.budget_paths = self.find_budget_paths(nuclei_module.budget)
+        self.cache_file = self.templates_dir / ".bbot_budget_cache.json"
+
+    async def setup(self):
+        self.yaml_list = await self.get_yaml_list()
+        self.budget_paths = self.find_budget_paths(self.parent.budget)
+        self.budget_paths_set = frozenset(self.budget_paths)
         self.collapsable_templates, self.severity_stats = self.find_collapsable_templates()
 
-    def get_yaml_list(self):
-        return list(self.templates_dir.rglob("*.yaml"))
+    # Returns a list of (filename, request paths, collapsable, severity) tuples. Templates are only parsed if they changed since the last run.
+    async def get_yaml_list(self):
+        yaml_files = sorted(self.walk_templates(str(self.templates_dir)))
+        fingerprint = self.fingerprint(yaml_files)
+        yaml_list = self.read_cache(fingerprint)
+        if yaml_list is None:
+            yaml_list = await self.parse_templates(yaml_files)
+            self.write_cache(fingerprint, yaml_list)
+        return yaml_list
+
+    # os.scandir() reuses the file type information from the directory listing instead of building a Path for every entry
+    def walk_templates(self, directory):
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            self.parent.warning(f"Unable to read nuclei templates directory: {e}")
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self.walk_templates(entry.path)
+                elif entry.name.endswith(".yaml") and entry.is_file():
+                    yield entry.path
+
+    # Template parsing is CPU-bound, so it is spread across the scan's process pool in chunks to amortize the IPC overhead
+    async def parse_templates(self, yaml_files):
+        chunks = [yaml_files[i : i + self.chunk_size] for i in range(0, len(yaml_files), self.chunk_size)]
+        results = await asyncio.gather(
+            *[self.parent.scan.run_in_executor_mp(extract_templates_meta, chunk) for chunk in chunks]
+        )
+        yaml_list = []
+        for chunk_results in results:
+            for template, error in chunk_results:
+                if error:
+                    self.parent.warning(error)
+                # templates without any (non-raw) request paths play no part in the budget calculations
+                if template[1]:
+                    yaml_list.append(template)
+        return yaml_list
+
+    def fingerprint(self, yaml_files):
+        h = hashlib.sha256(str(self.cache_version).encode())
+        for yf in yaml_files:
+            try:
+                st = os.stat(yf)
+            except OSError:
+                # the template disappeared since the walk, e.g. while another scan is updating templates
+                continue
+            h.update(f"{yf}\0{st.st_mtime_ns}\0{st.st_size}\n".encode())
+        return h.hexdigest()
+
+    def read_cache(self, fingerprint):
+        try:
+            with open(self.cache_file, "rb") as f:
+                cache = orjson.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cache, dict) or cache.get("fingerprint", "") != fingerprint:
+            return None
+        self.parent.debug(f"Using cached nuclei template metadata from {self.cache_file}")
+        return [tuple(t) for t in cache.get("templates", [])]
+
+    def write_cache(self, fingerprint, yaml_list):
+        # write to a temporary file first so a concurrent scan never reads a partial cache
+        tmp_file = self.cache_file.with_name(f"{self.cache_file.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_file, "wb") as f:
+                f.write(orjson.dumps({"fingerprint": fingerprint, "templates": yaml_list}))
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            self.parent.warning(f"failed to write nuclei template cache: {e}")
+            tmp_file.unlink(missing_ok=True)
 
     # Given the current budget setting, scan all of the templates for paths, sort them by frequency and select the first N (budget) items
     def find_budget_paths(self, budget):
-        path_frequency = {}
-        for yf in self.yaml_list:
-            if yf:
-                for paths in self.get_yaml_request_attr(yf, "path"):
-                    for path in paths:
-                        if path in path_frequency.keys():
-                            path_frequency[path] += 1
-                        else:
-                            path_frequency[path] = 1
-
-        sorted_dict = dict(sorted(path_frequency.items(), key=lambda item: item[1], reverse=True))
-        return list(dict(islice(sorted_dict.items(), budget)).keys())
-
-    def get_yaml_request_attr(self, yf, attr):
-        p = self.parse_yaml(yf)
-        requests = p.get("http", [])
-        for r in requests:
-            raw = r.get("raw")
-            if not raw:
-                res = r.get(attr)
-                yield res
-
-    def get_yaml_info_attr(self, yf, attr):
-        p = self.parse_yaml(yf)
-        info = p.get("info", [])
-        res = info.get(attr)
-        yield res
+        path_frequency = Counter()
+        path_frequency.update(
+            chain.from_iterable(paths for _, request_paths, _, _ in self.yaml_list for paths in request_paths)
+        )
+        return [path for path, count in path_frequency.most_common(budget)]
 
     # Parse through all templates and locate those which match the conditions necessary to collapse down to the budget setting
     def find_collapsable_templates(self):
         collapsable_templates = []
-        severity_dict = {}
-        for yf in self.yaml_list:
-            valid = True
-            if yf:
-                for paths in self.get_yaml_request_attr(yf, "path"):
-                    if set(paths).issubset(self.budget_paths):
-                        headers = self.get_yaml_request_attr(yf, "headers")
-                        for header in headers:
-                            if header:
-                                valid = False
-
-                        method = self.get_yaml_request_attr(yf, "method")
-                        for m in method:
-                            if m != "GET":
-                                valid = False
-
-                        max_redirects = self.get_yaml_request_attr(yf, "max-redirects")
-                        for mr in max_redirects:
-                            if mr:
-                                valid = False
-
-                        redirects = self.get_yaml_request_attr(yf, "redirects")
-                        for rd in redirects:
-                            if rd:
-                                valid = False
-
-                        cookie_reuse = self.get_yaml_request_attr(yf, "cookie-reuse")
-                        for c in cookie_reuse:
-                            if c:
-                                valid = False
-
-                        if valid:
-                            collapsable_templates.append(str(yf))
-                            severity_gen = self.get_yaml_info_attr(yf, "severity")
-                            severity = next(severity_gen)
-                            if severity in severity_dict.keys():
-                                severity_dict[severity] += 1
-                            else:
-                                severity_dict[severity] = 1
+        severity_dict = Counter()
+        for yf, request_paths, collapsable, severity in self.yaml_list:
+            if collapsable and any(self.budget_paths_set.issuperset(paths) for paths in request_paths):
+                collapsable_templates.append(yf)
+                severity_dict[severity] += 1
         return collapsable_templates, severity_dict
 
-    def parse_yaml(self, yamlfile):
-        if yamlfile not in self._yaml_files:
-            with open(yamlfile, "r") as stream:
-                try:
-                    y = yaml.safe_load(stream)
-                    self._yaml_files[yamlfile] = y
-                except yaml.YAMLError as e:
-                    self.parent.warning(f"failed to load yaml file: {e}")
-                    return {}
-        return self._yaml_files[yamlfile]
+
+# Reduce a parsed template down to the few attributes needed for the budget calculations
+def template_meta(parsed):
+    if not isinstance(parsed, dict):
+        parsed = {}
+    # raw requests are ignored by the budget calculations
+    requests = [r for r in parsed.get("http", []) if not r.get("raw")]
+    request_paths = [r["path"] for r in requests if r.get("path")]
+    # templates which send custom headers, non-GET requests, follow redirects or reuse cookies can't be collapsed
+    collapsable = not any(
+        r.get("headers")
+        or r.get("method") != "GET"
+        or r.get("max-redirects")
+        or r.get("redirects")
+        or r.get("cookie-reuse")
+        for r in requests
+    )
+    return request_paths, collapsable, parsed.get("info", {}).get("severity")
+
+
+# Runs inside the scan's process pool, so it must live at module level and report errors instead of logging them
+def extract_templates_meta(yaml_files):
+    results = []
+    for yf in yaml_files:
+        parsed, error = {}, ""
+        try:
+            with open(yf, "rb") as stream:
+                parsed = yaml.load(stream, Loader=SafeLoader)
+        except OSError as e:
+            error = f"failed to read yaml file: {e}"
+        except yaml.YAMLError as e:
+            error = f"failed to load yaml file: {e}"
+        results.append(((yf, *template_meta(parsed)), error))
+    return results
@@ -0,0 +1,211 @@
+import yaml
+
+from ..bbot_fixtures import *
+
+from bbot.modules.deadly import nuclei as nuclei_module
+
+
+def test_nuclei_template_meta():
+    template_meta = nuclei_module.template_meta
+
+    # a plain GET request can be collapsed
+    paths, collapsable, severity = template_meta(
+        {"info": {"severity": "high"}, "http": [{"method": "GET", "path": ["{{BaseURL}}/admin"]}]}
+    )
+    assert paths == [["{{BaseURL}}/admin"]]
+    assert collapsable == True
+    assert severity == "high"
+
+    # raw requests are ignored entirely
+    paths, collapsable, severity = template_meta(
+        {
+            "info": {"severity": "low"},
+            "http": [
+                {"raw": ["POST / HTTP/1.1"], "method": "POST", "headers": {"X": "y"}},
+                {"method": "GET", "path": ["{{BaseURL}}/"]},
+            ],
+        }
+    )
+    assert paths == [["{{BaseURL}}/"]]
+    assert collapsable == True
+    paths, collapsable, severity = template_meta({"info": {"severity": "low"}, "http": [{"raw": ["GET / HTTP/1.1"]}]})
+    assert paths == []
+
+    # a missing method is not assumed to be GET
+    _, collapsable, _ = template_meta({"info": {}, "http": [{"path": ["{{BaseURL}}/"]}]})
+    assert collapsable == False
+
+    # any request with headers, redirects or cookie reuse disqualifies the whole template
+    for attr, value in (
+        ("headers", {"X-Test": "1"}),
+        ("redirects", True),
+        ("max-redirects", 2),
+        ("cookie-reuse", True),
+    ):
+        template = {
+            "info": {"severity": "info"},
+            "http": [
+                {"method": "GET", "path": ["{{BaseURL}}/"]},
+                {"method": "GET", "path": ["{{BaseURL}}/a"], attr: value},
+            ],
+        }
+        _, collapsable, _ = template_meta(template)
+        assert collapsable == False, f"template with {attr} should not be collapsable"
+
+    # non-GET methods
+    _, collapsable, _ = template_meta({"info": {}, "http": [{"method": "POST", "path": ["{{BaseURL}}/"]}]})
+    assert collapsable == False
+
+    # empty or non-dict templates
+    assert template_meta(None) == ([], True, None)
+    assert template_meta(["a", "b"]) == ([], True, None)
+
+
+def test_nuclei_extract_templates_meta(tmp_path):
+    good = tmp_path / "good.yaml"
+    good.write_text(yaml.safe_dump({"info": {"severity": "medium"}, "http": [{"method": "GET", "path": ["/x"]}]}))
+    broken = tmp_path / "broken.yaml"
+    broken.write_text("a: [")
+    missing = tmp_path / "missing.yaml"
+    results = nuclei_module.extract_templates_meta([str(good), str(broken), str(missing)])
+    assert results[0] == ((str(good), [["/x"]], True, "medium"), "")
+    (broken_file, broken_paths, _, _), error = results[1]
+    assert broken_file == str(broken)
+    assert broken_paths == []
+    assert error.startswith("failed to load yaml file")
+    (missing_file, missing_paths, _, _), error = results[2]
+    assert missing_file == str(missing)
+    assert missing_paths == []
+    assert error.startswith("failed to read yaml file")
+
+
+def make_templates(templates_dir):
+    (templates_dir / "http" / "misc").mkdir(parents=True)
+    templates = {
+        "http/a.yaml": {"info": {"severity": "high"}, "http": [{"method": "GET", "path": ["{{BaseURL}}/"]}]},
+        "http/misc/b.yaml": {"info": {"severity": "low"}, "http": [{"method": "GET", "path": ["{{BaseURL}}/"]}]},
+        "http/misc/c.yaml": {"info": {"severity": "info"}, "http": [{"method": "POST", "path": ["{{BaseURL}}/x"]}]},
+    }
+    for filename, template in templates.items():
+        (templates_dir / filename).write_text(yaml.safe_dump(template))
+
+
+def make_nuclei(scan, templates_dir, monkeypatch):
+    module = nuclei_module.nuclei(scan)
+    module.nuclei_templates_dir = templates_dir
+    module.budget = 1
+    module.warnings = []
+    monkeypatch.setattr(module, "warning", lambda msg, *args, **kwargs: module.warnings.append(msg))
+    return module
+
+
+@pytest.mark.asyncio
+async def test_nuclei_budget_cache(scan, tmp_path, monkeypatch):
+    templates_dir = tmp_path / "nuclei-templates"
+    make_templates(templates_dir)
+    module = make_nuclei(scan, templates_dir, monkeypatch)
+
+    # templates are parsed in the scan's process pool, so count parses from the calling side
+    parsed_files = []
+    parse_templates = nuclei_module.NucleiBudget.parse_templates
+
+    async def counting_parse_templates(self, yaml_files):
+        parsed_files.extend(yaml_files)
+        return await parse_templates(self, yaml_files)
+
+    monkeypatch.setattr(nuclei_module.NucleiBudget, "parse_templates", counting_parse_templates)
+
+    async def run_budget():
+        parsed_files.clear()
+        nucleibudget = nuclei_module.NucleiBudget(module)
+        await nucleibudget.setup()
+        return nucleibudget
+
+    def check_results(nucleibudget):
+        assert nucleibudget.budget_paths == ["{{BaseURL}}/"]
+        assert sorted(nucleibudget.collapsable_templates) == sorted(
+            [str(templates_dir / "http/a.yaml"), str(templates_dir / "http/misc/b.yaml")]
+        )
+        assert nucleibudget.severity_stats == {"high": 1, "low": 1}
+
+    cache_file = templates_dir / ".bbot_budget_cache.json"
+
+    # cold run parses every template and writes the cache
+    check_results(await run_budget())
+    assert len(parsed_files) == 3
+    assert cache_file.is_file()
+    assert not [f for f in templates_dir.iterdir() if f.name.endswith(".tmp")]
+
+    # warm run is served entirely from the cache
+    check_results(await run_budget())
+    assert parsed_files == []
+
+    # a changed mtime invalidates the cache
+    a_yaml = templates_dir / "http/a.yaml"
+    st = a_yaml.stat()
+    os.utime(a_yaml, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    check_results(await run_budget())
+    assert len(parsed_files) == 3
+    check_results(await run_budget())
+    assert parsed_files == []
+
+    # so does a changed size
+    with open(templates_dir / "http/misc/b.yaml", "a") as f:
+        f.write("# comment\n")
+    check_results(await run_budget())
+    assert len(parsed_files) == 3
+
+    # a corrupt or non-dict cache falls back to parsing
+    for bad_cache in ("{not json", "[]", '"string"'):
+        cache_file.write_text(bad_cache)
+        check_results(await run_budget())
+        assert len(parsed_files) == 3
+
+    assert module.warnings == []
+
+
+@pytest.mark.asyncio
+async def test_nuclei_budget_missing_templates(scan, tmp_path, monkeypatch):
+    module = make_nuclei(scan, tmp_path / "nuclei-templates", monkeypatch)
+    nucleibudget = nuclei_module.NucleiBudget(module)
+    await nucleibudget.setup()
+    assert nucleibudget.budget_paths == []
+    assert nucleibudget.collapsable_templates == []
+    assert any("Unable to read nuclei templates directory" in w for w in module.warnings)
+
+
+@pytest.mark.asyncio
+async def test_nuclei_budget_unreadable_paths(scan, tmp_path, monkeypatch):
+    templates_dir = tmp_path / "nuclei-templates"
+    make_templates(templates_dir)
+    (templates_dir / "locked").mkdir()
+    (templates_dir / "locked" / "d.yaml").write_text((templates_dir / "http/a.yaml").read_text())
+    module = make_nuclei(scan, templates_dir, monkeypatch)
+
+    # an unreadable subdirectory is skipped
+    scandir = os.scandir
+
+    def locked_scandir(path):
+        if str(path).endswith("locked"):
+            raise PermissionError(13, "Permission denied", str(path))
+        return scandir(path)
+
+    monkeypatch.setattr(nuclei_module.os, "scandir", locked_scandir)
+
+    # a template which vanishes between the walk and the parse is reported and skipped
+    walk_templates = nuclei_module.NucleiBudget.walk_templates
+
+    def vanishing_walk_templates(self, directory):
+        yield from walk_templates(self, directory)
+        if directory == str(templates_dir):
+            yield str(templates_dir / "vanished.yaml")
+
+    monkeypatch.setattr(nuclei_module.NucleiBudget, "walk_templates", vanishing_walk_templates)
+
+    nucleibudget = nuclei_module.NucleiBudget(module)
+    await nucleibudget.setup()
+    assert sorted(nucleibudget.collapsable_templates) == sorted(
+        [str(templates_dir / "http/a.yaml"), str(templates_dir / "http/misc/b.yaml")]
+    )
+    assert any("Permission denied" in w for w in module.warnings)
+    assert any("failed to read yaml file" in w and "vanished.yaml" in w for w in module.warnings)
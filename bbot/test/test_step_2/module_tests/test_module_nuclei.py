@@ -1,4 +1,8 @@
+import os
+import pytest
+
 from .base import ModuleTestBase
+from bbot.modules.deadly.nuclei import nuclei
 
 
 class TestNucleiManual(ModuleTestBase):
@@ -152,3 +156,80 @@ class TestNucleiRetriesCustom(TestNucleiRetries):
     def check(self, module_test, events):
         with open(module_test.scan.home / "debug.log") as f:
             assert "-retries 1" in f.read()
+
+
+class TestNucleiCorrelation(TestNucleiRetries):
+    async def setup_after_prep(self, module_test):
+        module = module_test.module
+        scan = module_test.scan
+        parent_event = scan.make_event("http://evilcorp.com/", "URL", source=scan.root_event, tags=["status-200"])
+        child_event = scan.make_event("http://sub.evilcorp.com/", "URL", source=scan.root_event, tags=["status-200"])
+
+        async def execute_nuclei(nuclei_input):
+            for host in ("http://sub.evilcorp.com/", "www.evilcorp.com"):
+                yield "INFO", f"test-{host}", host, "", "Test", []
+
+        self.emitted = []
+        self.correlated = []
+        correlate_event = module.correlate_event
+
+        def new_correlate_event(events, host):
+            self.correlated.append(host)
+            return correlate_event(events, host)
+
+        with pytest.MonkeyPatch.context() as m:
+            m.setattr(module, "execute_nuclei", execute_nuclei)
+            m.setattr(module, "correlate_event", new_correlate_event)
+            m.setattr(module, "emit_event", lambda *args, **kwargs: self.emitted.append(args))
+            # the parent domain comes first in the batch, but must not steal the exact match
+            await module.handle_batch(parent_event, child_event)
+        self.parent_event = parent_event
+        self.child_event = child_event
+
+    def check(self, module_test, events):
+        results = {data["description"]: (data, source) for data, event_type, source in self.emitted}
+        data, source = results["template: [test-http://sub.evilcorp.com/], name: [Test]"]
+        assert source is self.child_event
+        assert data["host"] == "sub.evilcorp.com"
+        # results which only match a parent domain still fall back to correlate_event()
+        data, source = results["template: [test-www.evilcorp.com], name: [Test]"]
+        assert source is self.parent_event
+        assert data["host"] == "evilcorp.com"
+        assert len(self.correlated) == 1
+
+
+class TestNucleiConcurrencyAuto(TestNucleiRetries):
+    def check(self, module_test, events):
+        # concurrency is left unset, so it should scale with the CPU count
+        concurrency = min(25, (os.cpu_count() or 1) * 2)
+        with open(module_test.scan.home / "debug.log") as f:
+            assert f"-concurrency {concurrency}" in f.read()
+
+
+class TestNucleiUpdateTTL(TestNucleiRetries):
+    config_overrides = {
+        "interactsh_disable": True,
+        "modules": {"nuclei": {"tags": "musictraveler", "update_templates_ttl": 0}},
+    }
+
+    def check(self, module_test, events):
+        with open(module_test.scan.home / "debug.log") as f:
+            assert "Updating Nuclei templates" in f.read()
+
+
+class TestNucleiUpdateCached(TestNucleiRetries):
+    async def setup_before_prep(self, module_test):
+        await super().setup_before_prep(module_test)
+        version = module_test.scan.config.get("modules", {}).get("nuclei", {}).get("version", "")
+        templates_dir = module_test.scan.helpers.tools_dir / "nuclei-templates"
+        templates_dir.mkdir(parents=True, exist_ok=True)
+        self.update_cache_key = nuclei.templates_update_cache_key(version, templates_dir)
+        module_test.scan.helpers.cache_put(self.update_cache_key, "")
+
+    def check(self, module_test, events):
+        # don't let later tests skip the template update
+        module_test.scan.helpers.cache_filename(self.update_cache_key).unlink(missing_ok=True)
+        with open(module_test.scan.home / "debug.log") as f:
+            debug_log = f.read()
+            assert "skipping update" in debug_log
+            assert "Updating Nuclei templates" not in debug_log